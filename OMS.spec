@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('index.html', '.')],
-    hiddenimports=['flask', 'flask_cors', 'fpdf'],
+    hiddenimports=['flask', 'flask_cors', 'fpdf', 'waitress', 'orjson'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
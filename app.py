@@ -1,13 +1,22 @@
 # app.py - The Python Flask backend for the Bike Accessories Management System
 # This file handles all data logic and API endpoints, including database management and PDF generation.
 
-from flask import Flask, jsonify, request, send_from_directory, Response
+from flask import Flask, jsonify, request, send_file, Response
 from flask_cors import CORS
 import sqlite3
 from datetime import datetime
 import json
+import orjson
 from fpdf import FPDF
+from fpdf.enums import XPos, YPos
 import sys, os
+import functools
+import io
+import hashlib
+import re
+import queue
+from collections import Counter
+from contextlib import contextmanager
 
 app = Flask(__name__)
 # Enable CORS to allow the frontend to access the API
@@ -39,20 +48,171 @@ DATABASE = os.path.join(_app_data_dir(), "simple.db")
 #         shutil.copyfile(bundled_db, DATABASE)
 
 
+# --- Database Connection Pool ---
+
+DB_POOL_SIZE = 8  # Max number of SQLite connections kept open
+DB_CACHED_STATEMENTS = 256  # Per-connection prepared statement cache (sqlite3 default is 128)
+
+# Applied once to every new pooled connection
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # Readers don't block on writers
+    "PRAGMA synchronous=NORMAL",     # Safe with WAL, far fewer fsyncs
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",      # ~20 MB page cache per connection
+    "PRAGMA mmap_size=134217728",    # 128 MB memory-mapped I/O
+    "PRAGMA busy_timeout=5000",      # Wait up to 5s on a locked DB instead of failing
+)
+
+
+class ConnectionPool:
+    """
+    Small thread-safe pool of SQLite connections for a single database file.
+    Connections are opened lazily and kept open between requests so SQLite's
+    page cache stays warm instead of being rebuilt on every API call.
+    """
+
+    def __init__(self, database, size=DB_POOL_SIZE):
+        self.database = database
+        self._slots = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._slots.put(None)  # Empty slot, connection is opened on first use
+
+    def _connect(self):
+        # isolation_level=None: no implicit transactions. Single statements autocommit,
+        # multi-statement writes open their own BEGIN so they share one commit.
+        conn = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None,
+                               cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row  # Rows convert straight to dicts via dict(row)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._slots.get()
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.put(None)
+                raise
+        try:
+            yield conn
+        except Exception:
+            # Don't hand a possibly broken connection to the next request.
+            # Roll back first so the write lock is released even if a cursor
+            # still references the handle after close().
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            conn.close()
+            conn = None
+            raise
+        finally:
+            try:
+                if conn is not None and conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                conn.close()
+                conn = None
+            finally:
+                # Always return the slot, or the pool shrinks until get() blocks forever
+                self._slots.put(conn)
+
+
+_pool = ConnectionPool(DATABASE)
+
+
+def get_conn():
+    """Borrow a pooled connection: `with get_conn() as conn: ...`"""
+    return _pool.connection()
+
+
+# --- SQL Statements ---
+# Kept at module level so every request reuses the same strings and hits the
+# per-connection statement cache.
+
+SQL_INSERT_PRODUCT = "INSERT INTO products (sku, name, category, quantity, price) VALUES (?, ?, ?, ?, ?)"
+SQL_SELECT_PRODUCTS = "SELECT sku, name, category, quantity, price FROM products"
+SQL_UPDATE_PRODUCT = "UPDATE products SET name=?, category=?, quantity=?, price=? WHERE sku=?"
+SQL_DELETE_PRODUCT = "DELETE FROM products WHERE sku=?"
+SQL_SELECT_STOCK_IN = "SELECT sku, quantity, name FROM products WHERE sku IN ({placeholders})"
+SQL_SUBTRACT_STOCK = "UPDATE products SET quantity = quantity - ? WHERE sku = ?"
+SQL_SUBTRACT_STOCK_IF_AVAILABLE = "UPDATE products SET quantity = quantity - ? WHERE sku = ? AND quantity >= ?"
+SQL_RESTORE_STOCK = "UPDATE products SET quantity = quantity + ? WHERE sku = ?"
+
+SQL_INSERT_CATEGORY = "INSERT INTO categories (name) VALUES (?)"
+SQL_SELECT_CATEGORIES = "SELECT name FROM categories"
+SQL_DELETE_CATEGORY = "DELETE FROM categories WHERE name=?"
+
+SQL_SELECT_LAST_ORDER_NUMBER = "SELECT last_number FROM order_id_sequence WHERE id = 1"
+SQL_UPDATE_LAST_ORDER_NUMBER = "UPDATE order_id_sequence SET last_number = ? WHERE id = 1"
+
+SQL_INSERT_ORDER = """
+    INSERT INTO orders (
+        id, customer_name, mobile_number, email_address, order_date,
+        planned_delivery_date, payment_method, advance_received,
+        personalization_required, personalization_details, total_cost, gst_rate, updated_at
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_UPDATE_ORDER = """
+    UPDATE orders
+       SET customer_name=?, mobile_number=?, email_address=?, order_date=?,
+           planned_delivery_date=?, payment_method=?, advance_received=?,
+           personalization_required=?, personalization_details=?, gst_rate=?,
+           updated_at=?
+     WHERE id=?
+"""
+SQL_UPDATE_ORDER_TOTAL = """
+    UPDATE orders
+       SET total_cost = (SELECT COALESCE(SUM(price * quantity), 0) FROM order_items WHERE order_id = ?) * (1 + gst_rate)
+     WHERE id=?
+"""
+SQL_DELETE_ORDER = "DELETE FROM orders WHERE id=?"
+SQL_SELECT_ORDERS = """
+    SELECT id, customer_name AS customerName, mobile_number AS mobileNumber, order_date AS orderDate,
+           planned_delivery_date AS plannedDeliveryDate, total_cost AS totalCost
+      FROM orders ORDER BY id DESC
+"""
+SQL_SELECT_ORDER = """
+    SELECT id, customer_name, mobile_number, email_address, order_date,
+           planned_delivery_date, payment_method, advance_received,
+           personalization_required, personalization_details, total_cost, gst_rate
+      FROM orders WHERE id=?
+"""
+SQL_SELECT_ORDER_GST_RATE = "SELECT gst_rate FROM orders WHERE id=?"
+SQL_SELECT_ORDER_UPDATED_AT = "SELECT updated_at FROM orders WHERE id=?"
+SQL_SELECT_INVOICE_HEADER = """
+    SELECT customer_name, mobile_number, email_address, order_date,
+           planned_delivery_date, payment_method, advance_received, gst_rate
+      FROM orders WHERE id=? AND updated_at IS ?
+"""
+
+SQL_INSERT_ORDER_ITEM = "INSERT INTO order_items (order_id, product_sku, quantity, price, product_name) VALUES (?, ?, ?, ?, ?)"
+SQL_DELETE_ORDER_ITEMS = "DELETE FROM order_items WHERE order_id=?"
+SQL_SELECT_ORDER_ITEM_QUANTITIES = "SELECT product_sku, quantity FROM order_items WHERE order_id=?"
+SQL_SELECT_ORDER_ITEMS = "SELECT product_sku AS sku, product_name, quantity, price FROM order_items WHERE order_id=?"
+SQL_SELECT_INVOICE_ITEMS = "SELECT product_name, product_sku, quantity, price FROM order_items WHERE order_id=?"
+
+
 # --- Database Initialization and Management ---
 
-def ensure_orders_has_gst_rate_column():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("PRAGMA table_info(orders)")
-        cols = {row[1] for row in cursor.fetchall()}  # set of column names
-        if 'gst_rate' not in cols:
-            # Add with a default equal to your app-level GST_RATE
-            cursor.execute("ALTER TABLE orders ADD COLUMN gst_rate REAL DEFAULT ?", (float(GST_RATE),))
-            conn.commit()
-    finally:
-        conn.close()
+def _has_columns(cursor, tables, table, required):
+    """
+    Checks that `table` exists and has all `required` columns.
+    `tables` maps table name -> CREATE TABLE sql (from a single sqlite_master query).
+    The DDL text is checked first; PRAGMA table_info is only issued when it is inconclusive.
+    """
+    ddl = tables.get(table)
+    if ddl is None:
+        return False
+    if all(re.search(rf"\b{col}\b", ddl) for col in required):
+        return True
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = {info[1] for info in cursor.fetchall()}
+    return set(required) <= columns
 
 def init_db():
     """
@@ -60,305 +220,285 @@ def init_db():
     This function now dynamically checks and updates the schema for both 'orders' and 'order_items'
     to ensure all necessary columns are present, including gst_rate in orders.
     """
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    # Create the categories table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categories (
-            name TEXT PRIMARY KEY
-        )
-    ''')
-
-    # Products (inventory) table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            sku TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            category TEXT,
-            quantity INTEGER NOT NULL,
-            price REAL NOT NULL,
-            FOREIGN KEY(category) REFERENCES categories(name) ON DELETE SET NULL
-        )
-    ''')
-
-    # Ensure order_id_sequence exists
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS order_id_sequence (
-            id INTEGER PRIMARY KEY,
-            last_number INTEGER NOT NULL
-        )
-    ''')
-    cursor.execute("SELECT * FROM order_id_sequence WHERE id = 1")
-    if cursor.fetchone() is None:
-        cursor.execute("INSERT INTO order_id_sequence (id, last_number) VALUES (1, 0)")
-        conn.commit()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        # Foreign keys are only enforced while the schema is set up; request
+        # connections keep SQLite's default (off). Must be set outside a transaction.
+        cursor.execute("PRAGMA foreign_keys = ON;")
+        # Apply all schema changes in one transaction
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table'")
+        tables = {row[0]: row[1] or '' for row in cursor.fetchall()}
 
-    # Orders table (force recreate if missing essential columns)
-    cursor.execute("PRAGMA table_info(orders)")
-    orders_columns = [info[1] for info in cursor.fetchall()]
-    if ('orders' not in [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='orders'")] or
-        'email_address' not in orders_columns or
-        'planned_delivery_date' not in orders_columns or
-        'gst_rate' not in orders_columns):
-        print("Recreating 'orders' table with gst_rate...")
-        cursor.execute("DROP TABLE IF EXISTS orders")
-        cursor.execute(f'''
-            CREATE TABLE orders (
-                id TEXT PRIMARY KEY,
-                customer_name TEXT NOT NULL,
-                mobile_number TEXT NOT NULL,
-                email_address TEXT,
-                order_date TEXT NOT NULL,
-                planned_delivery_date TEXT,
-                payment_method TEXT,
-                advance_received REAL,
-                personalization_required INTEGER DEFAULT 0,
-                personalization_details TEXT,
-                total_cost REAL NOT NULL,
-                gst_rate REAL NOT NULL DEFAULT {float(GST_RATE)}
+        # Create the categories table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                name TEXT PRIMARY KEY
             )
         ''')
 
-    # Order items table (force recreate if missing product_sku)
-    cursor.execute("PRAGMA table_info(order_items)")
-    order_items_columns = [info[1] for info in cursor.fetchall()]
-    if ('order_items' not in [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='order_items'")] or
-        'product_sku' not in order_items_columns):
-        print("Recreating 'order_items' table...")
-        cursor.execute("DROP TABLE IF EXISTS order_items")
+        # Products (inventory) table
         cursor.execute('''
-            CREATE TABLE order_items (
-                order_id TEXT,
-                product_sku TEXT,
+            CREATE TABLE IF NOT EXISTS products (
+                sku TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                category TEXT,
                 quantity INTEGER NOT NULL,
                 price REAL NOT NULL,
-                product_name TEXT NOT NULL,
-                FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
-                FOREIGN KEY(product_sku) REFERENCES products(sku) ON DELETE SET NULL
+                FOREIGN KEY(category) REFERENCES categories(name) ON DELETE SET NULL
             )
         ''')
 
-    conn.commit()
-    conn.close()
+        # Ensure order_id_sequence exists
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS order_id_sequence (
+                id INTEGER PRIMARY KEY,
+                last_number INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("SELECT * FROM order_id_sequence WHERE id = 1")
+        if cursor.fetchone() is None:
+            cursor.execute("INSERT INTO order_id_sequence (id, last_number) VALUES (1, 0)")
+
+        # Orders table (force recreate if missing essential columns)
+        if not _has_columns(cursor, tables, 'orders', ('email_address', 'planned_delivery_date', 'gst_rate')):
+            print("Recreating 'orders' table with gst_rate...")
+            cursor.execute("DROP TABLE IF EXISTS orders")
+            cursor.execute(f'''
+                CREATE TABLE orders (
+                    id TEXT PRIMARY KEY,
+                    customer_name TEXT NOT NULL,
+                    mobile_number TEXT NOT NULL,
+                    email_address TEXT,
+                    order_date TEXT NOT NULL,
+                    planned_delivery_date TEXT,
+                    payment_method TEXT,
+                    advance_received REAL,
+                    personalization_required INTEGER DEFAULT 0,
+                    personalization_details TEXT,
+                    total_cost REAL NOT NULL,
+                    gst_rate REAL NOT NULL DEFAULT {float(GST_RATE)},
+                    updated_at TEXT
+                )
+            ''')
+        elif not _has_columns(cursor, tables, 'orders', ('updated_at',)):
+            # Non-destructive upgrade: existing orders keep a NULL updated_at
+            cursor.execute("ALTER TABLE orders ADD COLUMN updated_at TEXT")
+
+        # Order items table (force recreate if missing product_sku)
+        if not _has_columns(cursor, tables, 'order_items', ('product_sku',)):
+            print("Recreating 'order_items' table...")
+            cursor.execute("DROP TABLE IF EXISTS order_items")
+            cursor.execute('''
+                CREATE TABLE order_items (
+                    order_id TEXT,
+                    product_sku TEXT,
+                    quantity INTEGER NOT NULL,
+                    price REAL NOT NULL,
+                    product_name TEXT NOT NULL,
+                    FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+                    FOREIGN KEY(product_sku) REFERENCES products(sku) ON DELETE SET NULL
+                )
+            ''')
+
+        # Every order/invoice lookup filters order_items by order_id
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id)")
+
+        conn.commit()
+        # This connection goes back to the pool and serves requests next
+        cursor.execute("PRAGMA foreign_keys = OFF;")
+
+
+def load_stock(cursor, skus):
+    """
+    Fetches current stock for the given SKUs in a single query.
+    Returns {sku: (quantity, name)}; SKUs missing from products are absent.
+    """
+    skus = list(skus)
+    if not skus:
+        return {}
+    placeholders = ','.join('?' * len(skus))
+    cursor.execute(SQL_SELECT_STOCK_IN.format(placeholders=placeholders), skus)
+    return {sku: (qty, name) for sku, qty, name in cursor.fetchall()}
+
+
+def describe_stock_shortage(cursor, items):
+    """
+    Builds the error message for an order whose stock reservation failed.
+    Quantities are summed per SKU so repeated lines of one product are judged together.
+    """
+    needed = Counter()
+    for item in items:
+        needed[item['sku']] += int(item['quantity'])
+    stock = load_stock(cursor, needed)
+    for sku, qty_needed in needed.items():
+        if sku not in stock:
+            return f"Product with SKU '{sku}' not found."
+        current_qty, product_name = stock[sku]
+        if current_qty < qty_needed:
+            return (f"Insufficient stock for {product_name} (SKU: {sku}). "
+                    f"Available: {current_qty}, requested: {qty_needed}.")
+    return "Failed to update inventory for one or more SKUs."
 
 
 # --- API Endpoints ---
+
+def ojsonify(obj):
+    """Like jsonify, but serialized with orjson (used by the list endpoints)."""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
 @app.route('/api/products', methods=['POST'])
 def add_product():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    product = request.json
-    try:
-        cursor.execute("INSERT INTO products (sku, name, category, quantity, price) VALUES (?, ?, ?, ?, ?)",
-                       (product['sku'], product['name'], product['category'], product['quantity'], product['price']))
-        conn.commit()
-        return jsonify({"message": "Product added successfully"}), 201
-    except sqlite3.IntegrityError:
-        return jsonify({"message": "Product with this SKU already exists"}), 409
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        product = request.json
+        try:
+            cursor.execute(SQL_INSERT_PRODUCT, (product['sku'], product['name'], product['category'], product['quantity'], product['price']))
+            return jsonify({"message": "Product added successfully"}), 201
+        except sqlite3.IntegrityError:
+            return jsonify({"message": "Product with this SKU already exists"}), 409
 
 @app.route('/api/products', methods=['GET'])
 def get_products():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT sku, name, category, quantity, price FROM products")
-    products = [{"sku": row[0], "name": row[1], "category": row[2], "quantity": row[3], "price": row[4]} for row in cursor.fetchall()]
-    conn.close()
-    return jsonify(products)
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_PRODUCTS)
+        products = [dict(row) for row in cursor]
+        return ojsonify(products)
 
 @app.route('/api/products/<sku>', methods=['PUT'])
 def update_product(sku):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    product = request.json
-    try:
-        cursor.execute("UPDATE products SET name=?, category=?, quantity=?, price=? WHERE sku=?",
-                       (product['name'], product['category'], product['quantity'], product['price'], sku))
-        conn.commit()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        product = request.json
+        cursor.execute(SQL_UPDATE_PRODUCT, (product['name'], product['category'], product['quantity'], product['price'], sku))
         if cursor.rowcount == 0:
             return jsonify({"message": "Product not found"}), 404
         return jsonify({"message": "Product updated successfully"})
-    finally:
-        conn.close()
 
 @app.route('/api/products/<sku>', methods=['DELETE'])
 def delete_product(sku):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM products WHERE sku=?", (sku,))
-        conn.commit()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_DELETE_PRODUCT, (sku,))
         if cursor.rowcount == 0:
             return jsonify({"message": "Product not found"}), 404
         return jsonify({"message": "Product deleted successfully"})
-    finally:
-        conn.close()
 
 @app.route('/api/categories', methods=['POST'])
 def add_category():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    category = request.json
-    try:
-        cursor.execute("INSERT INTO categories (name) VALUES (?)", (category['name'],))
-        conn.commit()
-        return jsonify({"message": "Category added successfully"}), 201
-    except sqlite3.IntegrityError:
-        return jsonify({"message": "Category already exists"}), 409
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        category = request.json
+        try:
+            cursor.execute(SQL_INSERT_CATEGORY, (category['name'],))
+            return jsonify({"message": "Category added successfully"}), 201
+        except sqlite3.IntegrityError:
+            return jsonify({"message": "Category already exists"}), 409
 
 @app.route('/api/categories', methods=['GET'])
 def get_categories():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM categories")
-    categories = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return jsonify(categories)
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_CATEGORIES)
+        categories = [row[0] for row in cursor]
+        return ojsonify(categories)
 
 @app.route('/api/categories/<name>', methods=['DELETE'])
 def delete_category(name):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("DELETE FROM categories WHERE name=?", (name,))
-        conn.commit()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_DELETE_CATEGORY, (name,))
         if cursor.rowcount == 0:
             return jsonify({"message": "Category not found"}), 404
         return jsonify({"message": "Category deleted successfully"})
-    finally:
-        conn.close()
 
 # NOTE: All /api/bike_models endpoints removed intentionally
 
 @app.route('/api/orders', methods=['POST'])
 def handle_create_order():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("BEGIN IMMEDIATE")
-
-        order_data = request.json
-        customer_name = order_data['customerName']
-        mobile_number = order_data['mobileNumber']
-        email_address = order_data.get('emailAddress')
-        order_date = order_data['orderDate']
-        planned_delivery_date = order_data.get('plannedDeliveryDate')
-        payment_method = order_data.get('paymentMethod')
-        advance_received = float(order_data.get('advanceReceived', 0.0))
-        personalization_required = 1 if order_data.get('personalizationRequired') else 0
-        personalization_details = order_data.get('personalizationDetails', '')
-        items = order_data['items']  # [{sku, product_name, quantity, price}, ...]
-
-        # NEW: gstRate (decimal). Fall back to constant if not provided.
-        gst_rate = float(order_data.get('gstRate', GST_RATE))
-
-        # Validate all stock first
-        for item in items:
-            sku = item['sku']
-            qty_needed = int(item['quantity'])
-            cursor.execute("SELECT quantity, name FROM products WHERE sku=?", (sku,))
-            row = cursor.fetchone()
-            if row is None:
-                raise Exception(f"Product with SKU '{sku}' not found.")
-            current_qty, product_name = int(row[0]), row[1]
-            if current_qty < qty_needed:
-                raise Exception(f"Insufficient stock for {product_name} (SKU: {sku}). "
-                                f"Available: {current_qty}, requested: {qty_needed}.")
-
-        # Allocate order id
-        cursor.execute("SELECT last_number FROM order_id_sequence WHERE id = 1")
-        last_number = cursor.fetchone()[0]
-        new_number = last_number + 1
-        new_order_id = f"ORD{new_number:04d}"
-        cursor.execute("UPDATE order_id_sequence SET last_number = ? WHERE id = 1", (new_number,))
-
-        # 3) Totals
-        subtotal = sum(float(item['price']) * int(item['quantity']) for item in items)
-        total_cost = subtotal + (subtotal * gst_rate)
-
-        # Insert order header (NOTICE: gst_rate column)
-        cursor.execute("""
-            INSERT INTO orders (
-                id, customer_name, mobile_number, email_address, order_date,
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+
+            order_data = request.json
+            customer_name = order_data['customerName']
+            mobile_number = order_data['mobileNumber']
+            email_address = order_data.get('emailAddress')
+            order_date = order_data['orderDate']
+            planned_delivery_date = order_data.get('plannedDeliveryDate')
+            payment_method = order_data.get('paymentMethod')
+            advance_received = float(order_data.get('advanceReceived', 0.0))
+            personalization_required = 1 if order_data.get('personalizationRequired') else 0
+            personalization_details = order_data.get('personalizationDetails', '')
+            items = order_data['items']  # [{sku, product_name, quantity, price}, ...]
+
+            # NEW: gstRate (decimal). Fall back to constant if not provided.
+            gst_rate = float(order_data.get('gstRate', GST_RATE))
+
+            # Reserve stock first: each UPDATE only applies if enough quantity is left
+            deltas_rows = [(int(item['quantity']), item['sku'], int(item['quantity'])) for item in items]
+            cursor.executemany(SQL_SUBTRACT_STOCK_IF_AVAILABLE, deltas_rows)
+            # rowcount is summed across the batch: every item must hit exactly one product
+            if cursor.rowcount != len(deltas_rows):
+                conn.rollback()
+                raise Exception(describe_stock_shortage(cursor, items))
+
+            # Allocate order id
+            cursor.execute(SQL_SELECT_LAST_ORDER_NUMBER)
+            last_number = cursor.fetchone()[0]
+            new_number = last_number + 1
+            new_order_id = f"ORD{new_number:04d}"
+            cursor.execute(SQL_UPDATE_LAST_ORDER_NUMBER, (new_number,))
+
+            # 3) Totals
+            subtotal = sum(float(item['price']) * int(item['quantity']) for item in items)
+            # Same formula as SQL_UPDATE_ORDER_TOTAL so re-saving an order can't shift its total
+            total_cost = subtotal * (1 + gst_rate)
+
+            # Insert order header (NOTICE: gst_rate column)
+            cursor.execute(SQL_INSERT_ORDER, (
+                new_order_id, customer_name, mobile_number, email_address, order_date,
                 planned_delivery_date, payment_method, advance_received,
-                personalization_required, personalization_details, total_cost, gst_rate
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            new_order_id, customer_name, mobile_number, email_address, order_date,
-            planned_delivery_date, payment_method, advance_received,
-            personalization_required, personalization_details, total_cost, gst_rate
-        ))
-
-        for item in items:
-            cursor.execute("""
-                INSERT INTO order_items (order_id, product_sku, quantity, price, product_name)
-                VALUES (?, ?, ?, ?, ?)
-            """, (new_order_id, item['sku'], int(item['quantity']), float(item['price']), item['product_name']))
-
-        # 5) Subtract stock (after successful inserts)
-        for item in items:
-            cursor.execute("""
-                UPDATE products SET quantity = quantity - ?
-                WHERE sku = ?
-            """, (int(item['quantity']), item['sku']))
-            if cursor.rowcount == 0:
-                raise Exception(f"Failed to update inventory for SKU '{item['sku']}'.")
+                personalization_required, personalization_details, total_cost, gst_rate,
+                datetime.now().isoformat()
+            ))
 
-        conn.commit()
-        return jsonify({"message": "Order placed successfully", "order_id": new_order_id}), 201
+            rows = [(new_order_id, item['sku'], int(item['quantity']), float(item['price']), item['product_name'])
+                    for item in items]
+            cursor.executemany(SQL_INSERT_ORDER_ITEM, rows)
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 400
-    finally:
-        conn.close()
+            conn.commit()
+            return jsonify({"message": "Order placed successfully", "order_id": new_order_id}), 201
+
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 400
 
 
 
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, customer_name, mobile_number, order_date, planned_delivery_date, total_cost FROM orders ORDER BY id DESC")
-    orders = [{"id": row[0], "customerName": row[1], "mobileNumber": row[2], "orderDate": row[3], "plannedDeliveryDate": row[4], "totalCost": row[5]} for row in cursor.fetchall()]
-    conn.close()
-    return jsonify(orders)
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_ORDERS)
+        orders = [dict(row) for row in cursor]
+        return ojsonify(orders)
 
 @app.route('/api/orders/<order_id>', methods=['GET'])
 def get_order(order_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
-            SELECT id, customer_name, mobile_number, email_address, order_date,
-                   planned_delivery_date, payment_method, advance_received,
-                   personalization_required, personalization_details, total_cost, gst_rate
-            FROM orders WHERE id=?
-        """, (order_id,))
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_ORDER, (order_id,))
         row = cursor.fetchone()
         if not row:
             return jsonify({"error": "Order not found"}), 404
 
         (oid, cname, mobile, email, odate, pdd, pmethod, adv, pers_req, pers_det, total, gst_rate) = row
 
-        cursor.execute("""
-            SELECT product_sku, product_name, quantity, price
-              FROM order_items
-             WHERE order_id=?
-        """, (order_id,))
-        items = []
-        for sku, pname, qty, price in cursor.fetchall():
-            items.append({
-                "sku": sku,
-                "product_name": pname,
-                "quantity": int(qty),
-                "price": float(price)
-            })
+        cursor.execute(SQL_SELECT_ORDER_ITEMS, (order_id,))
+        items = [dict(item) for item in cursor]
 
         return jsonify({
             "id": oid,
@@ -368,281 +508,309 @@ def get_order(order_id):
             "orderDate": odate,
             "plannedDeliveryDate": pdd,
             "paymentMethod": pmethod,
-            "advanceReceived": float(adv or 0.0),
+            "advanceReceived": adv or 0.0,
             "personalizationRequired": bool(pers_req),
             "personalizationDetails": pers_det or "",
-            "totalCost": float(total or 0.0),
-            "gstRate": float(gst_rate if gst_rate is not None else GST_RATE),
+            "totalCost": total or 0.0,
+            "gstRate": gst_rate if gst_rate is not None else GST_RATE,
             "items": items
         })
-    finally:
-        conn.close()
 
 
 @app.route('/api/orders/<order_id>', methods=['PUT'])
 def update_order(order_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("BEGIN IMMEDIATE")
-
-        order_data = request.json
-        customer_name = order_data['customerName']
-        mobile_number = order_data['mobileNumber']
-        email_address = order_data.get('emailAddress')
-        order_date = order_data['orderDate']
-        planned_delivery_date = order_data.get('plannedDeliveryDate')
-        payment_method = order_data.get('paymentMethod') or None
-        advance_received = float(order_data.get('advanceReceived', 0.0))
-        personalization_required = 1 if order_data.get('personalizationRequired') else 0
-        personalization_details = order_data.get('personalizationDetails', '')
-
-        new_items = order_data['items']  # [{sku, product_name, quantity, price}, ...]
-        # NEW: gstRate (decimal). Fall back to stored value if not provided.
-        incoming_gst_rate = order_data.get('gstRate', None)
-
-        # Load previous items -> old map
-        cursor.execute("SELECT product_sku, quantity FROM order_items WHERE order_id=?", (order_id,))
-        old_items = {}
-        for sku, qty in cursor.fetchall():
-            old_items[sku] = old_items.get(sku, 0) + int(qty)
-
-        # Build new map
-        new_map = {}
-        for it in new_items:
-            new_map[it['sku']] = new_map.get(it['sku'], 0) + int(it['quantity'])
-
-        # Deltas
-        deltas = {}
-        for sku in set(old_items.keys()) | set(new_map.keys()):
-            deltas[sku] = new_map.get(sku, 0) - old_items.get(sku, 0)
-
-        # Validate positive deltas against stock
-        for sku, delta in deltas.items():
-            if delta > 0:
-                cursor.execute("SELECT quantity, name FROM products WHERE sku=?", (sku,))
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+
+            order_data = request.json
+            customer_name = order_data['customerName']
+            mobile_number = order_data['mobileNumber']
+            email_address = order_data.get('emailAddress')
+            order_date = order_data['orderDate']
+            planned_delivery_date = order_data.get('plannedDeliveryDate')
+            payment_method = order_data.get('paymentMethod') or None
+            advance_received = float(order_data.get('advanceReceived', 0.0))
+            personalization_required = 1 if order_data.get('personalizationRequired') else 0
+            personalization_details = order_data.get('personalizationDetails', '')
+
+            new_items = order_data['items']  # [{sku, product_name, quantity, price}, ...]
+            # NEW: gstRate (decimal). Fall back to stored value if not provided.
+            incoming_gst_rate = order_data.get('gstRate', None)
+
+            # Load previous items -> old map
+            cursor.execute(SQL_SELECT_ORDER_ITEM_QUANTITIES, (order_id,))
+            old_items = Counter()
+            for sku, qty in cursor:
+                old_items[sku] += qty
+
+            # Build new map
+            new_map = Counter()
+            for it in new_items:
+                new_map[it['sku']] += int(it['quantity'])
+
+            # Deltas (subtract() keeps zero and negative counts, unlike the - operator)
+            deltas = Counter(new_map)
+            deltas.subtract(old_items)
+
+            # Validate positive deltas against stock
+            stock = load_stock(cursor, [sku for sku, delta in deltas.items() if delta > 0])
+            for sku, delta in deltas.items():
+                if delta > 0:
+                    if sku not in stock:
+                        raise Exception(f"Product with SKU '{sku}' not found.")
+                    current_qty, product_name = stock[sku]
+                    if current_qty < delta:
+                        raise Exception(f"Insufficient stock for {product_name} (SKU: {sku}). "
+                                        f"Available: {current_qty}, additional needed: {delta}.")
+
+            # If gstRate not in payload, use the existing stored one
+            if incoming_gst_rate is None:
+                cursor.execute(SQL_SELECT_ORDER_GST_RATE, (order_id,))
                 row = cursor.fetchone()
-                if row is None:
-                    raise Exception(f"Product with SKU '{sku}' not found.")
-                current_qty, product_name = int(row[0]), row[1]
-                if current_qty < delta:
-                    raise Exception(f"Insufficient stock for {product_name} (SKU: {sku}). "
-                                    f"Available: {current_qty}, additional needed: {delta}.")
-
-        # If gstRate not in payload, use the existing stored one
-        if incoming_gst_rate is None:
-            cursor.execute("SELECT gst_rate FROM orders WHERE id=?", (order_id,))
-            row = cursor.fetchone()
-            stored_gst = float(row[0]) if row and row[0] is not None else float(GST_RATE)
-            gst_rate = stored_gst
-        else:
-            gst_rate = float(incoming_gst_rate)
-
-        # Recompute totals with gst_rate
-        subtotal = sum(float(it['price']) * int(it['quantity']) for it in new_items)
-        total_cost = subtotal + (subtotal * gst_rate)
-
-        # Update order header (+ gst_rate)
-        cursor.execute("""
-            UPDATE orders
-               SET customer_name=?, mobile_number=?, email_address=?, order_date=?,
-                   planned_delivery_date=?, payment_method=?, advance_received=?,
-                   personalization_required=?, personalization_details=?, total_cost=?, gst_rate=?
-             WHERE id=?
-        """, (
-            customer_name, mobile_number, email_address, order_date,
-            planned_delivery_date, payment_method, advance_received,
-            personalization_required, personalization_details, total_cost, gst_rate, order_id
-        ))
-        if cursor.rowcount == 0:
-            raise Exception("Order not found")
-
-        # Replace items
-        cursor.execute("DELETE FROM order_items WHERE order_id=?", (order_id,))
-        for it in new_items:
-            cursor.execute("""
-                INSERT INTO order_items (order_id, product_sku, quantity, price, product_name)
-                VALUES (?, ?, ?, ?, ?)
-            """, (order_id, it['sku'], int(it['quantity']), float(it['price']), it['product_name']))
-
-        # Apply stock deltas
-        for sku, delta in deltas.items():
-            if delta != 0:
-                cursor.execute("""
-                    UPDATE products SET quantity = quantity - ?
-                    WHERE sku = ?
-                """, (int(delta), sku))
+                stored_gst = row[0] if row and row[0] is not None else GST_RATE
+                gst_rate = stored_gst
+            else:
+                gst_rate = float(incoming_gst_rate)
+
+            # Update order header (+ gst_rate)
+            cursor.execute(SQL_UPDATE_ORDER, (
+                customer_name, mobile_number, email_address, order_date,
+                planned_delivery_date, payment_method, advance_received,
+                personalization_required, personalization_details, gst_rate,
+                datetime.now().isoformat(), order_id
+            ))
+            if cursor.rowcount == 0:
+                raise Exception("Order not found")
 
-        conn.commit()
-        return jsonify({"message": "Order updated successfully", "order_id": order_id}), 200
+            # Replace items
+            cursor.execute(SQL_DELETE_ORDER_ITEMS, (order_id,))
+            rows = [(order_id, it['sku'], int(it['quantity']), float(it['price']), it['product_name'])
+                    for it in new_items]
+            cursor.executemany(SQL_INSERT_ORDER_ITEM, rows)
+
+            # Recompute totals with gst_rate from the stored items
+            cursor.execute(SQL_UPDATE_ORDER_TOTAL, (order_id, order_id))
+
+            # Apply stock deltas
+            deltas_rows = [(delta, sku) for sku, delta in deltas.items() if delta != 0]
+            cursor.executemany(SQL_SUBTRACT_STOCK, deltas_rows)
+
+            conn.commit()
+            return jsonify({"message": "Order updated successfully", "order_id": order_id}), 200
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 400
-    finally:
-        conn.close()
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 400
 
 
 
 @app.route('/api/orders/<order_id>', methods=['DELETE'])
 def delete_order(order_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
-        # Atomic section: return stock then delete
-        cursor.execute("BEGIN IMMEDIATE")
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        try:
+            # Atomic section: return stock then delete
+            cursor.execute("BEGIN IMMEDIATE")
+
+            # Fetch items to restore inventory
+            cursor.execute(SQL_SELECT_ORDER_ITEM_QUANTITIES, (order_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                # If there are no items, still attempt to delete the order (may be already gone)
+                cursor.execute(SQL_DELETE_ORDER, (order_id,))
+                conn.commit()
+                if cursor.rowcount == 0:
+                    return jsonify({"message": "Order not found"}), 404
+                return jsonify({"message": "Order deleted successfully"}), 200
+
+            # Return stock for each line
+            for sku, qty in rows:
+                cursor.execute(SQL_RESTORE_STOCK, (qty, sku))
+                # If product row missing, we still proceed; inventory can't be restored for a deleted product.
+
+            # Delete order rows
+            cursor.execute(SQL_DELETE_ORDER_ITEMS, (order_id,))
+            cursor.execute(SQL_DELETE_ORDER, (order_id,))
 
-        # Fetch items to restore inventory
-        cursor.execute("SELECT product_sku, quantity FROM order_items WHERE order_id=?", (order_id,))
-        rows = cursor.fetchall()
-        if not rows:
-            # If there are no items, still attempt to delete the order (may be already gone)
-            cursor.execute("DELETE FROM orders WHERE id=?", (order_id,))
             conn.commit()
             if cursor.rowcount == 0:
                 return jsonify({"message": "Order not found"}), 404
             return jsonify({"message": "Order deleted successfully"}), 200
 
-        # Return stock for each line
-        for sku, qty in rows:
-            cursor.execute("""
-                UPDATE products SET quantity = quantity + ?
-                WHERE sku = ?
-            """, (int(qty), sku))
-            # If product row missing, we still proceed; inventory can't be restored for a deleted product.
-
-        # Delete order rows
-        cursor.execute("DELETE FROM order_items WHERE order_id=?", (order_id,))
-        cursor.execute("DELETE FROM orders WHERE id=?", (order_id,))
-
-        conn.commit()
-        if cursor.rowcount == 0:
-            return jsonify({"message": "Order not found"}), 404
-        return jsonify({"message": "Order deleted successfully"}), 200
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 400
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 400
-    finally:
-        conn.close()
 
+# Invoice layout settings, resolved once instead of on every cell.
+# "helvetica" is the core font fpdf2 substitutes for "Arial"; naming it directly
+# and passing new_x/new_y instead of the deprecated ln=True skips fpdf2's
+# per-call deprecation warnings (and their stack inspection).
+INVOICE_FONT = "helvetica"
+NEXT_LINE = {"new_x": XPos.LMARGIN, "new_y": YPos.NEXT}
 
-@app.route('/api/invoice_pdf/<order_id>', methods=['GET'])
-def generate_invoice_pdf(order_id):
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    try:
+@functools.lru_cache(maxsize=256)
+def _build_invoice_pdf(order_id, updated_at):
+    """
+    Renders the invoice PDF for one version of an order and returns the bytes.
+    Keyed on (order_id, updated_at), so any edit to the order bypasses the cached copy.
+    Raises LookupError if that version of the order no longer exists.
+    """
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        # Read header and items from one snapshot
+        cursor.execute("BEGIN")
         # Load header (includes gst_rate)
-        cursor.execute("""
-            SELECT customer_name, mobile_number, email_address, order_date,
-                   planned_delivery_date, payment_method, advance_received, gst_rate
-              FROM orders WHERE id=?
-        """, (order_id,))
+        cursor.execute(SQL_SELECT_INVOICE_HEADER, (order_id, updated_at))
         hdr = cursor.fetchone()
-        if not hdr:
-            return jsonify({"error": "Order not found"}), 404
-
-        (customer_name, mobile_number, email_address, order_date,
-         planned_delivery_date, payment_method, advance_received, gst_rate) = hdr
-
-        if gst_rate is None:
-            gst_rate = float(GST_RATE)
-        else:
-            gst_rate = float(gst_rate)
 
         # Items
-        cursor.execute("""
-            SELECT product_name, product_sku, quantity, price
-              FROM order_items WHERE order_id=?
-        """, (order_id,))
+        cursor.execute(SQL_SELECT_INVOICE_ITEMS, (order_id,))
         items = cursor.fetchall()
-        #print(items)
-        # Totals using gst_rate
-        subtotal = sum(float(price) * int(qty) for (_, _, qty, price) in items)
-        gst_amount = subtotal * gst_rate
-        total_cost = subtotal + gst_amount
-        advance = float(advance_received or 0.0)
-        balance_due = max(total_cost - advance, 0.0)
-
-        # --- PDF ---
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=16)
-        pdf.cell(0, 10, "INVOICE", ln=True, align='C')
-
-        pdf.set_font("Arial", size=12)
-        pdf.cell(0, 8, f"Invoice ID: {order_id}", ln=True)
-        pdf.cell(0, 8, f"Order Date: {order_date}", ln=True)
-        pdf.cell(0, 8, f"Planned Delivery: {planned_delivery_date or 'N/A'}", ln=True)
-        pdf.ln(2)
-        pdf.cell(0, 8, f"Customer: {customer_name}", ln=True)
-        pdf.cell(0, 8, f"Mobile: {mobile_number}", ln=True)
-        if email_address:
-            pdf.cell(0, 8, f"Email: {email_address}", ln=True)
-        if payment_method:
-            pdf.cell(0, 8, f"Payment Method: {payment_method}", ln=True)
-
-        pdf.ln(6)
-        # Table header
-        pdf.set_font("Arial", 'B', 11)
-        pdf.cell(80, 8, "Product", 1)
-        pdf.cell(25, 8, "SKU", 1)
-        pdf.cell(25, 8, "Qty", 1, align='R')
-        pdf.cell(30, 8, "Unit Price", 1, align='R')
-        pdf.cell(30, 8, "Subtotal", 1, ln=True, align='R')
-
-        pdf.set_font("Arial", size=11)
-        for (pname, sku, qty, price) in items:
-            line_sub = float(price) * int(qty)
-            pdf.cell(80, 8, str(pname), 1)
-            pdf.cell(25, 8, str(sku), 1)
-            pdf.cell(25, 8, f"{int(qty)}", 1, align='R')
-            pdf.cell(30, 8, f"INR {float(price):.2f}", 1, align='R')
-            pdf.cell(30, 8, f"INR {line_sub:.2f}", 1, ln=True, align='R')
-
-        pdf.ln(4)
-        # Totals
-        pdf.cell(140, 8, "Subtotal", 1)
-        pdf.cell(40, 8, f"INR {subtotal:.2f}", 1, ln=True, align='R')
-
-        pdf.cell(140, 8, f"GST ({gst_rate*100:.2f}%)", 1)
-        pdf.cell(40, 8, f"INR {gst_amount:.2f}", 1, ln=True, align='R')
-
-        pdf.cell(140, 8, "Total Cost", 1)
-        pdf.cell(40, 8, f"INR {total_cost:.2f}", 1, ln=True, align='R')
-
-        if advance > 0:
-            pdf.cell(140, 8, "Advance Received", 1)
-            pdf.cell(40, 8, f"INR {advance:.2f}", 1, ln=True, align='R')
-
-        pdf.cell(140, 8, "Balance Due", 1)
-        pdf.cell(40, 8, f"INR {balance_due:.2f}", 1, ln=True, align='R')
-
-        # Return PDF
-        return Response(pdf.output(dest='S').encode('latin1'),
-                        mimetype='application/pdf',
-                        headers={'Content-Disposition': f'attachment; filename=invoice_{order_id}.pdf'})
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        conn.close()
+        conn.commit()
 
+    if not hdr:
+        raise LookupError("Order not found")
+
+    (customer_name, mobile_number, email_address, order_date,
+     planned_delivery_date, payment_method, advance_received, gst_rate) = hdr
+
+    if gst_rate is None:
+        gst_rate = GST_RATE
+
+    #print(items)
+    # Totals using gst_rate
+    subtotal = sum(price * qty for (_, _, qty, price) in items)
+    gst_amount = subtotal * gst_rate
+    total_cost = subtotal + gst_amount
+    advance = advance_received or 0.0
+    balance_due = max(total_cost - advance, 0.0)
+
+    # --- PDF ---
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font(INVOICE_FONT, size=16)
+    pdf.cell(0, 10, "INVOICE", **NEXT_LINE, align='C')
+
+    pdf.set_font(INVOICE_FONT, size=12)
+    pdf.cell(0, 8, f"Invoice ID: {order_id}", **NEXT_LINE)
+    pdf.cell(0, 8, f"Order Date: {order_date}", **NEXT_LINE)
+    pdf.cell(0, 8, f"Planned Delivery: {planned_delivery_date or 'N/A'}", **NEXT_LINE)
+    pdf.ln(2)
+    pdf.cell(0, 8, f"Customer: {customer_name}", **NEXT_LINE)
+    pdf.cell(0, 8, f"Mobile: {mobile_number}", **NEXT_LINE)
+    if email_address:
+        pdf.cell(0, 8, f"Email: {email_address}", **NEXT_LINE)
+    if payment_method:
+        pdf.cell(0, 8, f"Payment Method: {payment_method}", **NEXT_LINE)
+
+    pdf.ln(6)
+    # Table header
+    pdf.set_font(INVOICE_FONT, 'B', 11)
+    pdf.cell(80, 8, "Product", 1)
+    pdf.cell(25, 8, "SKU", 1)
+    pdf.cell(25, 8, "Qty", 1, align='R')
+    pdf.cell(30, 8, "Unit Price", 1, align='R')
+    pdf.cell(30, 8, "Subtotal", 1, **NEXT_LINE, align='R')
+
+    pdf.set_font(INVOICE_FONT, size=11)
+    for (pname, sku, qty, price) in items:
+        line_sub = price * qty
+        pdf.cell(80, 8, str(pname), 1)
+        pdf.cell(25, 8, str(sku), 1)
+        pdf.cell(25, 8, f"{qty}", 1, align='R')
+        pdf.cell(30, 8, f"INR {price:.2f}", 1, align='R')
+        pdf.cell(30, 8, f"INR {line_sub:.2f}", 1, **NEXT_LINE, align='R')
+
+    pdf.ln(4)
+    # Totals
+    pdf.cell(140, 8, "Subtotal", 1)
+    pdf.cell(40, 8, f"INR {subtotal:.2f}", 1, **NEXT_LINE, align='R')
+
+    pdf.cell(140, 8, f"GST ({gst_rate*100:.2f}%)", 1)
+    pdf.cell(40, 8, f"INR {gst_amount:.2f}", 1, **NEXT_LINE, align='R')
+
+    pdf.cell(140, 8, "Total Cost", 1)
+    pdf.cell(40, 8, f"INR {total_cost:.2f}", 1, **NEXT_LINE, align='R')
+
+    if advance > 0:
+        pdf.cell(140, 8, "Advance Received", 1)
+        pdf.cell(40, 8, f"INR {advance:.2f}", 1, **NEXT_LINE, align='R')
+
+    pdf.cell(140, 8, "Balance Due", 1)
+    pdf.cell(40, 8, f"INR {balance_due:.2f}", 1, **NEXT_LINE, align='R')
+
+    # fpdf2 returns the document as a bytearray, no latin1 round-trip needed
+    return bytes(pdf.output())
+
+
+def _order_updated_at(order_id):
+    """Returns the (updated_at,) row for an order, or None if it doesn't exist."""
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_SELECT_ORDER_UPDATED_AT, (order_id,))
+        return cursor.fetchone()
+
+
+INVOICE_BUILD_ATTEMPTS = 2  # Retries when the order is edited while its PDF is built
 
 @app.route('/api/invoice_pdf/<order_id>', methods=['GET'])
-def get_invoice_pdf(order_id):
-    pdf, error = generate_invoice_pdf(order_id)
-    if error:
-        return jsonify({"error": error}), 404
-
-    return Response(pdf.output(dest='S').encode('latin1'), mimetype='application/pdf',
-                    headers={'Content-Disposition': f'attachment; filename=invoice_{order_id}.pdf'})
+def generate_invoice_pdf(order_id):
+    row = _order_updated_at(order_id)
+    if not row:
+        return jsonify({"error": "Order not found"}), 404
+
+    updated_at = row[0]
+    etag = f"{order_id}-{updated_at}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    for _ in range(INVOICE_BUILD_ATTEMPTS):
+        try:
+            pdf_bytes = _build_invoice_pdf(order_id, updated_at)
+            break
+        except LookupError:
+            # The order changed after updated_at was read: 404 only if it's really gone
+            row = _order_updated_at(order_id)
+            if not row:
+                return jsonify({"error": "Order not found"}), 404
+            updated_at = row[0]
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        return jsonify({"error": "Order is being modified, please try again"}), 409
+
+    etag = f"{order_id}-{updated_at}"
+
+    # Return PDF; send_file streams the buffer out in blocks (wsgi.file_wrapper under waitress)
+    return send_file(io.BytesIO(pdf_bytes),
+                     mimetype='application/pdf',
+                     as_attachment=True,
+                     download_name=f'invoice_{order_id}.pdf',
+                     etag=etag)
 
 
 # Serve static files for the frontend
+INDEX_CACHE_CONTROL = 'public, max-age=300, must-revalidate'
+
+@functools.lru_cache(maxsize=1)
+def _load_index_html():
+    # Read once per process; the page only changes with a new build
+    with open(os.path.join(_bundle_dir(), 'index.html'), 'rb') as f:
+        html = f.read()
+    return html, hashlib.sha1(html).hexdigest()
+
 @app.route('/')
 def index():
-    return send_from_directory('.', 'index.html')
+    html, etag = _load_index_html()
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = INDEX_CACHE_CONTROL
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     init_db()
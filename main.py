@@ -7,12 +7,16 @@ Created on Fri Sep  5 11:25:58 2025
 
 # main.py
 import threading, time, webbrowser
-from app import app
+from waitress import serve
+from app import app, init_db, DB_POOL_SIZE
 
 def run_server():
-    app.run(host="127.0.0.1", port=5000, debug=False, use_reloader=False, threaded=True)
+    # One worker thread per pooled DB connection so requests never wait on the pool
+    serve(app, host="127.0.0.1", port=5000, threads=DB_POOL_SIZE)
 
 if __name__ == "__main__":
+    # Create/upgrade the per-user DB schema before the first request is served
+    init_db()
     t = threading.Thread(target=run_server, daemon=True)
     t.start()
     time.sleep(0.8)